@@ -1,15 +1,13 @@
 from __future__ import annotations
 
-from typing import TYPE_CHECKING, Optional
+from typing import TYPE_CHECKING, Any, Callable, Dict, List, Optional, Set, Tuple
 
 import logging
-import math
+from concurrent.futures.thread import ThreadPoolExecutor
 
 from pajbot.managers.handler import HandlerManager
 from pajbot.modules import BaseModule, ModuleSetting
 
-import pytimeparse
-
 if TYPE_CHECKING:
     from pajbot.bot import Bot
 
@@ -17,21 +15,89 @@ from requests import HTTPError
 
 log = logging.getLogger(__name__)
 
+# (chat mode label, Helix API method, positional arguments)
+_PendingHelixCall = Tuple[str, Callable[..., Any], Tuple[Any, ...]]
+
+# Chat message sent when updating a chat mode fails because the bot's token is no longer authorized, keyed by mode label
+_LABEL_TO_REAUTH_MSG: Dict[str, str] = {
+    label: f"Error: The bot must be re-authed in order to update {label}."
+    for label in ("emote only mode", "subscriber only mode", "unique chat mode", "slow mode", "follower mode")
+}
+
+
+# Number of seconds per unit word accepted by the hand-written duration parser
+_DURATION_UNITS: Dict[bytes, int] = {
+    **dict.fromkeys((b"s", b"sec", b"secs", b"second", b"seconds"), 1),
+    **dict.fromkeys((b"m", b"min", b"mins", b"minute", b"minutes"), 60),
+    **dict.fromkeys((b"h", b"hr", b"hrs", b"hour", b"hours"), 3600),
+    **dict.fromkeys((b"d", b"day", b"days"), 86400),
+    **dict.fromkeys((b"w", b"wk", b"wks", b"week", b"weeks"), 604800),
+}
+
+
+def _parse_simple_duration(duration_str: str) -> Optional[int]:
+    """Parse a duration made up of integer/unit pairs (e.g. "5 days 12 hours" or "1w2d") into a number of seconds.
+    Returns None if the string contains anything else, so the caller can fall back to a more lenient parser."""
+    try:
+        data = duration_str.encode("ascii")
+    except UnicodeEncodeError:
+        return None
+
+    total = 0
+    i = 0
+    n = len(data)
+    while i < n:
+        c = data[i]
+        if c == 0x20:
+            i += 1
+            continue
+
+        if not 0x30 <= c <= 0x39:
+            return None
+
+        value = 0
+        while i < n and 0x30 <= data[i] <= 0x39:
+            value = value * 10 + (data[i] - 0x30)
+            i += 1
+
+        while i < n and data[i] == 0x20:
+            i += 1
+
+        unit_start = i
+        while i < n and (0x61 <= data[i] <= 0x7A or 0x41 <= data[i] <= 0x5A):
+            i += 1
+
+        unit_s = _DURATION_UNITS.get(data[unit_start:i].lower())
+        if unit_s is None:
+            return None
+
+        total += value * unit_s
+
+    return total
+
 
 def parse_follower_duration(duration_str: str) -> Optional[int]:
     """Parse an input string (e.g. 2w) and output it as a number of minutes,
     or None if the string was unable to be parsed.
     We ensure the duration returned is no less than 0 and no more than 3 months."""
+    duration_str = duration_str.strip()
     if duration_str == "":
         return None
 
-    duration_s: Optional[int | float] = pytimeparse.parse(duration_str)
+    duration_s: Optional[int | float] = _parse_simple_duration(duration_str)
+
+    if duration_s is None:
+        # Fall back to pytimeparse for any format our simple parser doesn't understand (e.g. 1.5h or 1:30:00)
+        # It is imported lazily since it's rarely needed, and compiles a lot of regexes on import
+        import pytimeparse
+
+        duration_s = pytimeparse.parse(duration_str)
 
     if duration_s is None:
         log.error(f"Failed to parse time from {duration_str}")
         return None
 
-    duration_m = max(math.floor(duration_s / 60), 0)
+    duration_m = max(int(duration_s // 60), 0)
 
     return min(duration_m, 129600)
 
@@ -46,6 +112,16 @@ class DefaultChatStatesModule(BaseModule):
     OFFLINE_PHRASE = "Goes Offline"
     NEVER_PHRASE = "Never"
     PHRASE_OPTIONS = [ONLINE_PHRASE, OFFLINE_PHRASE, NEVER_PHRASE]
+    FOLLOWERS_DURATION = "__followers__"
+    # (option setting key, Helix API method name, chat mode label, extra argument setting key)
+    # FOLLOWERS_DURATION as the extra argument key means the parsed followers only duration is passed instead
+    _MODE_DISPATCH: List[Tuple[str, str, str, Optional[str]]] = [
+        ("emoteonly", "update_emote_only_mode", "emote only mode", None),
+        ("subonly", "update_sub_mode", "subscriber only mode", None),
+        ("r9k", "update_unique_chat_mode", "unique chat mode", None),
+        ("slow_option", "update_slow_mode", "slow mode", "slow_time"),
+        ("followersonly_option", "update_follower_mode", "follower mode", FOLLOWERS_DURATION),
+    ]
     SETTINGS = [
         ModuleSetting(
             key="emoteonly",
@@ -110,89 +186,124 @@ class DefaultChatStatesModule(BaseModule):
     def __init__(self, bot: Optional[Bot]) -> None:
         super().__init__(bot)
 
+        self._cached_followers_time_str: Optional[str] = None
+        self._cached_followers_duration_m: Optional[int] = None
+
+        # Snapshot of the settings used by the stream handlers for every chat mode that isn't set to "Never",
+        # refreshed in on_loaded: (option value, bound Helix API method, chat mode label, extra argument)
+        self._mode_options: List[Tuple[str, Callable[..., Any], str, Any]] = []
+        self._followers_time_str = ""
+
+        # Stream handlers currently registered with the HandlerManager, only populated while the module is enabled
+        self._enabled = False
+        self._registered: Set[str] = set()
+
+        # Shared between stream events for the Helix calls, only exists while the module is enabled
+        self._executor: Optional[ThreadPoolExecutor] = None
+
+    def on_loaded(self) -> None:
+        self._mode_options = []
+        self._followers_time_str = self.settings["followersonly_time"]
+
+        if self.bot is None:
+            # Without a bot there is no Helix API to bind the chat mode methods to, nor any stream events to handle
+            return
+
+        helix = self.bot.twitch_helix_api
+        for option_key, method_name, label, extra_key in self._MODE_DISPATCH:
+            option = self.settings[option_key]
+            if option == self.NEVER_PHRASE:
+                # Never applied, so there's no need to keep it around or look up its extra argument
+                continue
+
+            extra = extra_key
+            if extra_key is not None and extra_key != self.FOLLOWERS_DURATION:
+                extra = self.settings[extra_key]
+            self._mode_options.append((option, getattr(helix, method_name), label, extra))
+
+        if self._enabled:
+            self._update_handlers()
+
+    def _get_follower_duration(self) -> Optional[int]:
+        """Return the parsed followers only duration in minutes, only re-parsing it if the setting has changed"""
+        followers_time_str = self._followers_time_str
+
+        if followers_time_str != self._cached_followers_time_str:
+            self._cached_followers_duration_m = parse_follower_duration(followers_time_str)
+            self._cached_followers_time_str = followers_time_str
+
+        return self._cached_followers_duration_m
+
+    def _call_helix(self, label: str, fn: Callable[..., Any], *args: Any, **kwargs: Any) -> None:
+        """Call the given Helix API method, logging any HTTP error that occurs while updating the given chat mode"""
+        assert self.bot is not None
+
+        try:
+            fn(*args, **kwargs)
+        except HTTPError as e:
+            if e.response.status_code == 401:
+                log.error(f"Failed to update {label}, unauthorized: {e} - {e.response.text}")
+                reauth_msg = _LABEL_TO_REAUTH_MSG.get(label)
+                if reauth_msg is None:
+                    reauth_msg = f"Error: The bot must be re-authed in order to update {label}."
+                self.bot.execute_now(self.bot.send_message, reauth_msg)
+            else:
+                log.error(f"Failed to update {label}: {e} - {e.response.text}")
+
+    def _run_helix_calls(self, pending: List[_PendingHelixCall]) -> None:
+        """Run the given Helix API calls concurrently, waiting for all of them to finish"""
+        if not pending:
+            return
+
+        if self._executor is None:
+            log.warning("Helix calls were not run in DefaultChatStatesModule because the module is not enabled")
+            return
+
+        futures = [self._executor.submit(self._call_helix, label, fn, *args) for label, fn, args in pending]
+
+        # Wait for all calls, re-raising any unexpected (non-HTTP) exception here
+        for future in futures:
+            future.result()
+
+    def _apply_modes(self, target_phrase: str) -> None:
+        """Enable every chat mode whose option setting matches the given phrase"""
+        assert self.bot is not None
+
+        bot = self.bot
+        streamer_id = bot.streamer.id
+        bot_user_id = bot.bot_user.id
+        token_manager = bot.bot_token_manager
+
+        pending: List[_PendingHelixCall] = []
+
+        for option, method, label, extra in self._mode_options:
+            if option != target_phrase:
+                continue
+
+            # Every option reads "Enable ... mode when the stream...", so the mode is enabled (state=True)
+            # for both the online and offline phrase - the phrase only decides on which transition it happens
+            args: Tuple[Any, ...] = (streamer_id, bot_user_id, token_manager, True)
+            if extra == self.FOLLOWERS_DURATION:
+                duration_m = self._get_follower_duration()
+                if duration_m is None and self._followers_time_str.strip() != "":
+                    # An empty duration is valid (followers only mode with no minimum follow time),
+                    # but an unparseable one would enable followers only mode with a duration the user didn't ask for
+                    log.warning(f"Not updating {label} because the duration could not be parsed")
+                    continue
+                args += (duration_m,)
+            elif extra is not None:
+                args += (extra,)
+
+            pending.append((label, method, args))
+
+        self._run_helix_calls(pending)
+
     def on_stream_start(self, **rest) -> bool:
         if self.bot is None:
             log.warning("on_stream_start failed in DefaultChatStatesModule because bot is None")
             return True
 
-        if self.settings["emoteonly"] == self.ONLINE_PHRASE:
-            try:
-                self.bot.twitch_helix_api.update_emote_only_mode(
-                    self.bot.streamer.id,
-                    self.bot.bot_user.id,
-                    self.bot.bot_token_manager,
-                    True,
-                )
-            except HTTPError as e:
-                if e.response.status_code == 401:
-                    log.error(f"Failed to update emote only mode, unauthorized: {e} - {e.response.text}")
-                    self.bot.send_message("Error: The bot must be re-authed in order to update emote only mode.")
-                else:
-                    log.error(f"Failed to update emote only mode: {e} - {e.response.text}")
-
-        if self.settings["subonly"] == self.ONLINE_PHRASE:
-            try:
-                self.bot.twitch_helix_api.update_sub_mode(
-                    self.bot.streamer.id,
-                    self.bot.bot_user.id,
-                    self.bot.bot_token_manager,
-                    True,
-                )
-            except HTTPError as e:
-                if e.response.status_code == 401:
-                    log.error(f"Failed to update subscriber only mode, unauthorized: {e} - {e.response.text}")
-                    self.bot.send_message("Error: The bot must be re-authed in order to update subscriber only mode.")
-                else:
-                    log.error(f"Failed to update subscriber only mode: {e} - {e.response.text}")
-
-        if self.settings["r9k"] == self.ONLINE_PHRASE:
-            try:
-                self.bot.twitch_helix_api.update_unique_chat_mode(
-                    self.bot.streamer.id,
-                    self.bot.bot_user.id,
-                    self.bot.bot_token_manager,
-                    True,
-                )
-            except HTTPError as e:
-                if e.response.status_code == 401:
-                    log.error(f"Failed to update unique chat mode, unauthorized: {e} - {e.response.text}")
-                    self.bot.send_message("Error: The bot must be re-authed in order to update unique chat mode.")
-                else:
-                    log.error(f"Failed to update unique chat mode: {e} - {e.response.text}")
-
-        if self.settings["slow_option"] == self.ONLINE_PHRASE:
-            try:
-                self.bot.twitch_helix_api.update_slow_mode(
-                    self.bot.streamer.id,
-                    self.bot.bot_user.id,
-                    self.bot.bot_token_manager,
-                    True,
-                    self.settings["slow_time"],
-                )
-            except HTTPError as e:
-                if e.response.status_code == 401:
-                    log.error(f"Failed to update slow mode, unauthorized: {e} - {e.response.text}")
-                    self.bot.send_message("Error: The bot must be re-authed in order to update slow mode.")
-                else:
-                    log.error(f"Failed to update slow_mode: {e} - {e.response.text}")
-
-        if self.settings["followersonly_option"] == self.ONLINE_PHRASE:
-            duration_m = parse_follower_duration(self.settings["followersonly_time"])
-
-            try:
-                self.bot.twitch_helix_api.update_follower_mode(
-                    self.bot.streamer.id,
-                    self.bot.bot_user.id,
-                    self.bot.bot_token_manager,
-                    state=True,
-                    duration_m=duration_m,
-                )
-            except HTTPError as e:
-                if e.response.status_code == 401:
-                    log.error(f"Failed to update follower mode, unauthorized: {e} - {e.response.text}")
-                    self.bot.send_message("Error: The bot must be re-authed in order to update follower mode.")
-                else:
-                    log.error(f"Failed to update follower_mode: {e} - {e.response.text}")
+        self._apply_modes(self.ONLINE_PHRASE)
 
         return True
 
@@ -201,91 +312,43 @@ class DefaultChatStatesModule(BaseModule):
             log.warning("on_stream_stop failed in DefaultChatStatesModule because bot is None")
             return True
 
-        if self.settings["emoteonly"] == self.OFFLINE_PHRASE:
-            try:
-                self.bot.twitch_helix_api.update_emote_only_mode(
-                    self.bot.streamer.id,
-                    self.bot.bot_user.id,
-                    self.bot.bot_token_manager,
-                    True,
-                )
-            except HTTPError as e:
-                if e.response.status_code == 401:
-                    log.error(f"Failed to update emote only mode, unauthorized: {e} - {e.response.text}")
-                    self.bot.send_message("Error: The bot must be re-authed in order to update emote only mode.")
-                else:
-                    log.error(f"Failed to update emote only mode: {e} - {e.response.text}")
-
-        if self.settings["subonly"] == self.OFFLINE_PHRASE:
-            try:
-                self.bot.twitch_helix_api.update_sub_mode(
-                    self.bot.streamer.id,
-                    self.bot.bot_user.id,
-                    self.bot.bot_token_manager,
-                    True,
-                )
-            except HTTPError as e:
-                if e.response.status_code == 401:
-                    log.error(f"Failed to update subscriber only mode, unauthorized: {e} - {e.response.text}")
-                    self.bot.send_message("Error: The bot must be re-authed in order to update subscriber only mode.")
-                else:
-                    log.error(f"Failed to update subscriber only mode: {e} - {e.response.text}")
-
-        if self.settings["r9k"] == self.OFFLINE_PHRASE:
-            try:
-                self.bot.twitch_helix_api.update_unique_chat_mode(
-                    self.bot.streamer.id,
-                    self.bot.bot_user.id,
-                    self.bot.bot_token_manager,
-                    True,
-                )
-            except HTTPError as e:
-                if e.response.status_code == 401:
-                    log.error(f"Failed to update unique chat mode, unauthorized: {e} - {e.response.text}")
-                    self.bot.send_message("Error: The bot must be re-authed in order to update unique chat mode.")
-                else:
-                    log.error(f"Failed to update unique chat mode: {e} - {e.response.text}")
-
-        if self.settings["slow_option"] == self.OFFLINE_PHRASE:
-            try:
-                self.bot.twitch_helix_api.update_slow_mode(
-                    self.bot.streamer.id,
-                    self.bot.bot_user.id,
-                    self.bot.bot_token_manager,
-                    True,
-                    self.settings["slow_time"],
-                )
-            except HTTPError as e:
-                if e.response.status_code == 401:
-                    log.error(f"Failed to update slow mode, unauthorized: {e} - {e.response.text}")
-                    self.bot.send_message("Error: The bot must be re-authed in order to update slow mode.")
-                else:
-                    log.error(f"Failed to update slow_mode: {e} - {e.response.text}")
-
-        if self.settings["followersonly_option"] == self.OFFLINE_PHRASE:
-            duration_m = parse_follower_duration(self.settings["followersonly_time"])
-
-            try:
-                self.bot.twitch_helix_api.update_follower_mode(
-                    self.bot.streamer.id,
-                    self.bot.bot_user.id,
-                    self.bot.bot_token_manager,
-                    state=True,
-                    duration_m=duration_m,
-                )
-            except HTTPError as e:
-                if e.response.status_code == 401:
-                    log.error(f"Failed to update follower mode, unauthorized: {e} - {e.response.text}")
-                    self.bot.send_message("Error: The bot must be re-authed in order to update follower mode.")
-                else:
-                    log.error(f"Failed to update follower_mode: {e} - {e.response.text}")
+        self._apply_modes(self.OFFLINE_PHRASE)
 
         return True
 
+    def _update_handlers(self) -> None:
+        """Only keep the stream handlers registered whose phrase is used by at least one chat mode"""
+        handlers: Dict[str, Tuple[str, Callable[..., bool]]] = {
+            "on_stream_start": (self.ONLINE_PHRASE, self.on_stream_start),
+            "on_stream_stop": (self.OFFLINE_PHRASE, self.on_stream_stop),
+        }
+
+        for event, (phrase, handler) in handlers.items():
+            wanted = any(option == phrase for option, _, _, _ in self._mode_options)
+
+            if wanted and event not in self._registered:
+                HandlerManager.add_handler(event, handler)
+                self._registered.add(event)
+            elif not wanted and event in self._registered:
+                HandlerManager.remove_handler(event, handler)
+                self._registered.discard(event)
+
     def enable(self, bot: Optional[Bot]) -> None:
-        HandlerManager.add_handler("on_stream_start", self.on_stream_start)
-        HandlerManager.add_handler("on_stream_stop", self.on_stream_stop)
+        self._enabled = True
+        if self._executor is None:
+            self._executor = ThreadPoolExecutor(
+                max_workers=len(self._MODE_DISPATCH), thread_name_prefix="default-chat-states"
+            )
+        self._update_handlers()
 
     def disable(self, bot: Optional[Bot]) -> None:
-        HandlerManager.remove_handler("on_stream_start", self.on_stream_start)
-        HandlerManager.remove_handler("on_stream_stop", self.on_stream_stop)
+        self._enabled = False
+        if "on_stream_start" in self._registered:
+            HandlerManager.remove_handler("on_stream_start", self.on_stream_start)
+        if "on_stream_stop" in self._registered:
+            HandlerManager.remove_handler("on_stream_stop", self.on_stream_stop)
+        self._registered.clear()
+
+        if self._executor is not None:
+            self._executor.shutdown(wait=False)
+            self._executor = None
@@ -0,0 +1,22 @@
+from pajbot.modules.default_chat_states import parse_follower_duration
+
+
+def test_parse_follower_duration():
+    assert parse_follower_duration("") is None
+    assert parse_follower_duration("   ") is None
+    assert parse_follower_duration("30m") == 30
+    assert parse_follower_duration("30 minutes") == 30
+    assert parse_follower_duration("1 week") == 10080
+    assert parse_follower_duration("5 days 12 hours") == 7920
+    assert parse_follower_duration("1w2d") == 12960
+    assert parse_follower_duration("90s") == 1
+    assert parse_follower_duration("59 seconds") == 0
+    assert parse_follower_duration("2H") == 120
+    assert parse_follower_duration("20 weeks") == 129600
+
+
+def test_parse_follower_duration_fallback():
+    assert parse_follower_duration("1.5h") == 90
+    assert parse_follower_duration("1:30:00") == 90
+    assert parse_follower_duration("5 mangos") is None
+    assert parse_follower_duration("m") is None